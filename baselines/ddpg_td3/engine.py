@@ -2,6 +2,7 @@ import time
 from itertools import count
 
 import torch
+import torch.distributed as dist
 from lagom import Logger
 from lagom import BaseEngine
 from lagom.transform import describe
@@ -44,6 +45,8 @@ class Engine(BaseEngine):
         return train_logs, eval_logs
 
     def eval(self, n=None, **kwargs):
+        if dist.is_available() and dist.is_initialized() and dist.get_rank() != 0:
+            return None  # with DDP only rank 0 evaluates, its logs are the ones dumped
         t0 = time.perf_counter()
         with torch.no_grad():
             D = self.runner(self.agent, self.eval_env, 10, mode='eval')
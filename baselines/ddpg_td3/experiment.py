@@ -1,9 +1,15 @@
 import os
+import inspect
+from shutil import copyfile
+from pathlib import Path
 import gym
+import torch
+import torch.distributed as dist
 
 from lagom import EpisodeRunner
 from lagom import RandomAgent
 from lagom.utils import pickle_dump
+from lagom.utils import yaml_dump
 from lagom.utils import set_global_seeds
 from lagom.experiment import Config
 from lagom.experiment import Grid
@@ -37,6 +43,7 @@ config = Config(
      'agent.target_noise': 0.2,
      'agent.target_noise_clip': 0.5,
      'agent.policy_delay': 2,
+     'agent.use_bf16': True,  # bf16 autocast of TD3 network forwards, only used on GPU supporting bf16
      
      'replay.capacity': 1000000, 
      'replay.init_trial': 10,  # number of random rollouts initially
@@ -74,17 +81,63 @@ def run(config, seed, device, logdir):
     engine = Engine(config, agent=agent, random_agent=random_agent, env=env, eval_env=eval_env, runner=runner, replay=replay, logdir=logdir)
     
     train_logs, eval_logs = engine.train()
-    pickle_dump(obj=train_logs, f=logdir/'train_logs', ext='.pkl')
-    pickle_dump(obj=eval_logs, f=logdir/'eval_logs', ext='.pkl')
+    if not (dist.is_available() and dist.is_initialized()) or dist.get_rank() == 0:
+        pickle_dump(obj=train_logs, f=logdir/'train_logs', ext='.pkl')
+        pickle_dump(obj=eval_logs, f=logdir/'eval_logs', ext='.pkl')
     return None  
+
+
+def run_distributed(run, config, seeds, log_dir):
+    r"""Run each configuration and seed in turn with DistributedDataParallel over all processes 
+    launched by ``torchrun``, e.g. ``torchrun --nproc_per_node=2 experiment.py``. 
+    
+    Each rank collects from its own environment (seeded by ``seed + rank``) into its own replay buffer, 
+    gradients of actor and critic are all-reduced across ranks. Only rank 0 writes logs and checkpoints. 
+    
+    .. note::
+    
+        Only TD3 is supported, the DDPG agent is not DDP-aware. 
+    """
+    configs = config.make_configs()
+    assert all([config['agent.use_td3'] for config in configs]), 'only TD3 supports distributed training'
+    local_rank = int(os.environ['LOCAL_RANK'])
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+        device = torch.device(f'cuda:{local_rank}')
+    else:
+        device = torch.device('cpu')
+    dist.init_process_group(backend='nccl' if device.type == 'cuda' else 'gloo')
+    rank = dist.get_rank()
+    log_path = Path(log_dir)
+    if rank == 0:  # same layout as run_experiment, so the loggings can be plotted in the same way
+        source_path = log_path/'source_files'
+        source_path.mkdir(parents=True, exist_ok=True)
+        [copyfile(s, source_path/s.name) for s in Path(inspect.getsourcefile(run)).parent.glob('*.py')]
+        for config in configs:
+            for seed in seeds:
+                (log_path/f'{config["ID"]}'/f'{seed}').mkdir(parents=True, exist_ok=True)
+            yaml_dump(obj=config, f=log_path/f'{config["ID"]}'/'config', ext='.yml')
+        pickle_dump(configs, log_path/'configs', ext='.pkl')
+    dist.barrier()
+    for config in configs:
+        for seed in seeds:
+            logdir = log_path/f'{config["ID"]}'/f'{seed}'
+            run(config, seed + rank, device, logdir)
+    dist.destroy_process_group()
     
 
 if __name__ == '__main__':
-    run_experiment(run=run, 
-                   config=config, 
-                   seeds=[4153361530, 3503522377, 2876994566, 172236777, 3949341511], 
-                   log_dir='logs/default',
-                   max_workers=os.cpu_count(), 
-                   chunksize=1, 
-                   use_gpu=True,  # GPU much faster, note that performance differs between CPU/GPU
-                   gpu_ids=None)
+    if 'LOCAL_RANK' in os.environ:  # launched by torchrun
+        run_distributed(run=run, 
+                        config=config, 
+                        seeds=[4153361530, 3503522377, 2876994566, 172236777, 3949341511], 
+                        log_dir='logs/default')
+    else:
+        run_experiment(run=run, 
+                       config=config, 
+                       seeds=[4153361530, 3503522377, 2876994566, 172236777, 3949341511], 
+                       log_dir='logs/default',
+                       max_workers=os.cpu_count(), 
+                       chunksize=1, 
+                       use_gpu=True,  # GPU much faster, note that performance differs between CPU/GPU
+                       gpu_ids=None)
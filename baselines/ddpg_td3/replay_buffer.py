@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 from gym.spaces import flatdim
 from lagom.utils import tensorify
 
@@ -9,36 +10,86 @@ class ReplayBuffer(object):
         self.capacity = capacity
         self.device = device
         
-        self.observations = np.zeros([capacity, flatdim(env.observation_space)], dtype=np.float32)
-        self.actions = np.zeros([capacity, flatdim(env.action_space)], dtype=np.float32)
-        self.rewards = np.zeros([capacity, 1], dtype=np.float32)
-        self.next_observations = np.zeros([capacity, flatdim(env.observation_space)], dtype=np.float32)
-        self.masks = np.zeros([capacity, 1], dtype=np.float32)
+        # Storage lives on the device, so sampling a minibatch is pure on-device indexing
+        self.observations = torch.zeros([capacity, flatdim(env.observation_space)], dtype=torch.float32, device=device)
+        self.actions = torch.zeros([capacity, flatdim(env.action_space)], dtype=torch.float32, device=device)
+        self.rewards = torch.zeros([capacity, 1], dtype=torch.float32, device=device)
+        self.next_observations = torch.zeros([capacity, flatdim(env.observation_space)], dtype=torch.float32, device=device)
+        self.masks = torch.zeros([capacity, 1], dtype=torch.float32, device=device)
         
         self.size = 0
         self.pointer = 0
-        
+    
     def __len__(self):
         return self.size
-
-    def _add(self, observation, action, reward, next_observation, terminal):
-        self.observations[self.pointer] = observation
-        self.actions[self.pointer] = action
-        self.rewards[self.pointer] = reward
-        self.next_observations[self.pointer] = next_observation
-        self.masks[self.pointer] = 1. - terminal
+    
+    def add(self, traj):
+        T = traj.T
+        observations = np.asarray(traj.observations, dtype=np.float32).reshape(T + 1, -1)
+        actions = np.asarray(traj.actions, dtype=np.float32).reshape(T, -1)
+        rewards = np.asarray(traj.rewards, dtype=np.float32).reshape(T, 1)
+        masks = 1. - np.asarray([traj[t].terminal() for t in range(1, T+1)], dtype=np.float32).reshape(T, 1)
         
-        self.pointer = (self.pointer+1) % self.capacity
-        self.size = min(self.size + 1, self.capacity)
+        # Write the whole trajectory with one host-to-device copy per field, wrapping around the capacity
+        idx = torch.as_tensor((self.pointer + np.arange(T)) % self.capacity, device=self.device)
+        self.observations[idx] = tensorify(observations[:-1], self.device)
+        self.actions[idx] = tensorify(actions, self.device)
+        self.rewards[idx] = tensorify(rewards, self.device)
+        self.next_observations[idx] = tensorify(observations[1:], self.device)
+        self.masks[idx] = tensorify(masks, self.device)
         
-    def add(self, traj):
-        for t in range(1, traj.T+1):
-            self._add(traj[t-1].observation, traj.actions[t-1], traj[t].reward, traj[t].observation, traj[t].terminal())
-
+        self.pointer = (self.pointer + T) % self.capacity
+        self.size = min(self.size + T, self.capacity)
+    
     def sample(self, batch_size):
-        idx = np.random.randint(0, self.size, size=batch_size)
-        return list(map(lambda x: tensorify(x, self.device), [self.observations[idx], 
-                                                              self.actions[idx], 
-                                                              self.rewards[idx], 
-                                                              self.next_observations[idx], 
-                                                              self.masks[idx]]))
+        idx = torch.randint(0, self.size, size=(batch_size,), device=self.device)
+        return [self.observations[idx],
+                self.actions[idx],
+                self.rewards[idx],
+                self.next_observations[idx],
+                self.masks[idx]]
+
+
+class Prefetcher(object):
+    r"""Iterates over ``n`` minibatches sampled from a replay buffer, where the next minibatch is 
+    sampled ahead (on a side CUDA stream if on GPU) while the current one is trained on. 
+    
+    .. note::
+    
+        With on-device storage, sampling is only a few asynchronous kernel launches, so the overlap
+        comes from the side stream alone, no background thread is needed. 
+    
+    Example::
+    
+        for observations, actions, rewards, next_observations, masks in Prefetcher(replay, batch_size=100, n=T):
+            critic_step(observations, actions, rewards, next_observations, masks)
+    
+    """
+    def __init__(self, replay, batch_size, n):
+        self.replay = replay
+        self.batch_size = batch_size
+        self.n = n
+        
+        device = torch.device(replay.device)
+        self.stream = torch.cuda.Stream(device=device) if device.type == 'cuda' else None
+        
+    def _sample(self):
+        if self.stream is None:
+            return self.replay.sample(self.batch_size)
+        # wait for all work queued so far on the main stream, e.g. writes in ReplayBuffer.add and the last step
+        self.stream.wait_stream(torch.cuda.current_stream(self.stream.device))
+        with torch.cuda.stream(self.stream):
+            return self.replay.sample(self.batch_size)
+        
+    def __iter__(self):
+        if self.n <= 0:
+            return
+        batch = self._sample()
+        for i in range(self.n):
+            if self.stream is not None:
+                current_stream = torch.cuda.current_stream(self.stream.device)
+                current_stream.wait_stream(self.stream)
+                [x.record_stream(current_stream) for x in batch]
+            next_batch = self._sample() if i < self.n - 1 else None
+            yield batch
+            batch = next_batch
@@ -1,17 +1,34 @@
+import pickle
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
 
 from gym.spaces import flatdim
 from lagom import BaseAgent
 from lagom.utils import tensorify
 from lagom.utils import numpify
 from lagom.networks import Module
-from lagom.networks import make_fc
 from lagom.networks import ortho_init
-from lagom.transform import describe
+from lagom.transform import Describe
+
+from baselines.ddpg_td3.replay_buffer import Prefetcher
+
+
+class MLP(nn.Module):
+    r"""Two hidden layers with in-place ReLU, saves one activation allocation per hidden layer. """
+    def __init__(self, in_features, hidden1, hidden2):
+        super().__init__()
+        self.l1 = nn.Linear(in_features, hidden1)
+        self.l2 = nn.Linear(hidden1, hidden2)
+        
+    def forward(self, x):
+        h = F.relu(self.l1(x), inplace=True)
+        h = F.relu(self.l2(h), inplace=True)
+        return h
 
 
 class Actor(Module):
@@ -21,19 +38,22 @@ class Actor(Module):
         self.env = env
         self.device = device
         
-        self.feature_layers = make_fc(flatdim(env.observation_space), [400, 300])
+        # scripted MLP: forward runs in the TorchScript interpreter, no Python dispatch per layer
+        # (bias-add is already inside addmm and the ReLUs are in-place, there is nothing left to fuse)
+        self.net = torch.jit.script(MLP(flatdim(env.observation_space), 400, 300))
         self.action_head = nn.Linear(300, flatdim(env.action_space))
         
         assert np.unique(env.action_space.high).size == 1
         assert -np.unique(env.action_space.low).item() == np.unique(env.action_space.high).item()
-        self.max_action = env.action_space.high[0]
+        self.register_buffer('max_action', torch.as_tensor(env.action_space.high[0], dtype=torch.float32))
         
         self.to(self.device)
         
     def forward(self, x):
-        for layer in self.feature_layers:
-            x = F.relu(layer(x))
-        x = self.max_action*torch.tanh(self.action_head(x))
+        x = self.net(x)
+        # output head always in fp32, also under bf16 autocast
+        with torch.autocast('cuda', enabled=False):
+            x = self.max_action*torch.tanh(self.action_head(x.float()))
         return x
 
 
@@ -44,119 +64,220 @@ class Critic(Module):
         self.env = env
         self.device = device
         
-        # Q1
-        self.first_feature_layers = make_fc(flatdim(env.observation_space) + flatdim(env.action_space), [400, 300])
-        self.first_Q_head = nn.Linear(300, 1)
-        
-        # Q2
-        self.second_feature_layers = make_fc(flatdim(env.observation_space) + flatdim(env.action_space), [400, 300])
-        self.second_Q_head = nn.Linear(300, 1)
+        # Both Q networks stacked along a leading dimension of size 2, each layer of both 
+        # networks is then computed in a single batched matmul
+        obs_dim = flatdim(env.observation_space)
+        action_dim = flatdim(env.action_space)
+        # first layer weight split into observation and action slabs, avoids concatenating the inputs
+        self.obs_weight = nn.Parameter(torch.empty(2, obs_dim, 400))
+        self.action_weight = nn.Parameter(torch.empty(2, action_dim, 400))
+        self.weights = nn.ParameterList([nn.Parameter(torch.empty(2, 400, 300)), nn.Parameter(torch.empty(2, 300, 1))])
+        self.biases = nn.ParameterList([nn.Parameter(torch.empty(2, 1, out_features)) for out_features in [400, 300, 1]])
+        self.reset_parameters()
         
         self.to(self.device)
         
-    def Q1(self, x, action):
-        x = torch.cat([x, action], dim=-1)
-        for layer in self.first_feature_layers:
-            x = F.relu(layer(x))
-        x = self.first_Q_head(x)
+    def reset_parameters(self):
+        # same as default initialization of nn.Linear, first layer fan-in counts both slabs
+        bound = 1/np.sqrt(self.obs_weight.shape[1] + self.action_weight.shape[1])
+        nn.init.uniform_(self.obs_weight, -bound, bound)
+        nn.init.uniform_(self.action_weight, -bound, bound)
+        nn.init.uniform_(self.biases[0], -bound, bound)
+        for weight, bias in zip(self.weights, self.biases[1:]):
+            bound = 1/np.sqrt(weight.shape[1])
+            nn.init.uniform_(weight, -bound, bound)
+            nn.init.uniform_(bias, -bound, bound)
+            
+    def _Q(self, x, action, k):
+        x = torch.addmm(torch.addmm(self.biases[0][k], x, self.obs_weight[k]), action, self.action_weight[k])
+        x = x.relu_()
+        for weight, bias in zip(self.weights[:-1], self.biases[1:-1]):
+            x = torch.addmm(bias[k], x, weight[k]).relu_()
+        # output head always in fp32, Q values and thus TD targets must not be rounded to bf16
+        with torch.autocast('cuda', enabled=False):
+            x = torch.addmm(self.biases[-1][k], x.float(), self.weights[-1][k])
         return x
+        
+    def Q1(self, x, action):
+        return self._Q(x, action, 0)
     
     def Q2(self, x, action):
-        x = torch.cat([x, action], dim=-1)
-        for layer in self.second_feature_layers:
-            x = F.relu(layer(x))
-        x = self.second_Q_head(x)
-        return x
+        return self._Q(x, action, 1)
         
     def forward(self, x, action):
-        return self.Q1(x, action), self.Q2(x, action)
+        # returns both Qs stacked, shape [2, N, 1]
+        x = torch.baddbmm(self.biases[0], x.expand(2, -1, -1), self.obs_weight)
+        x = torch.baddbmm(x, action.expand(2, -1, -1), self.action_weight)
+        x = x.relu_()
+        for weight, bias in zip(self.weights[:-1], self.biases[1:-1]):
+            x = torch.baddbmm(bias, x, weight).relu_()
+        # output head always in fp32, Q values and thus TD targets must not be rounded to bf16
+        with torch.autocast('cuda', enabled=False):
+            x = torch.baddbmm(self.biases[-1], x.float(), self.weights[-1])
+        return x
     
     
+def unwrap(module):
+    r"""Returns the underlying module if wrapped by :class:`DistributedDataParallel`. """
+    return module.module if isinstance(module, DDP) else module
+
+
 class Agent(BaseAgent):
     def __init__(self, config, env, device, **kwargs):
         super().__init__(config, env, device, **kwargs)
         
+        # with DDP each process holds replicas of actor/critic and gradients are all-reduced in backward, 
+        # targets are built after wrapping, so they copy the parameters broadcast from rank 0
+        use_cuda = torch.device(device).type == 'cuda'
+        self.distributed = dist.is_available() and dist.is_initialized()
         self.actor = Actor(config, env, device, **kwargs)
-        self.actor_target = Actor(config, env, device, **kwargs)
-        self.actor_target.load_state_dict(self.actor.state_dict())
-        self.actor_optimizer = optim.Adam(self.actor.parameters(), lr=config['agent.actor.lr'])
-        
         self.critic = Critic(config, env, device, **kwargs)
+        if self.distributed:
+            # both networks are well below the default bucket size, so DDP already all-reduces all gradients of 
+            # each in a single bucket, with gradient_as_bucket_view the .grad tensors are views into it (no copy)
+            make_ddp = lambda module: DDP(module, 
+                                          device_ids=[torch.device(device).index] if use_cuda else None, 
+                                          broadcast_buffers=False, 
+                                          gradient_as_bucket_view=True)
+            self.actor = make_ddp(self.actor)
+            self.critic = make_ddp(self.critic)
+        
+        self.actor_target = Actor(config, env, device, **kwargs)
+        self.actor_target.load_state_dict(unwrap(self.actor).state_dict())
         self.critic_target = Critic(config, env, device, **kwargs)
-        self.critic_target.load_state_dict(self.critic.state_dict())
-        self.critic_optimizer = optim.Adam(self.critic.parameters(), lr=config['agent.critic.lr'])
+        self.critic_target.load_state_dict(unwrap(self.critic).state_dict())
+        # targets are only updated by polyak averaging, no autograd bookkeeping needed
+        self.actor_target.requires_grad_(False)
+        self.critic_target.requires_grad_(False)
+        
+        # fused Adam on GPU: one multi-tensor kernel per step
+        make_optimizer = lambda params, lr: optim.Adam(params, lr=lr, fused=use_cuda)
+        self.actor_optimizer = make_optimizer(self.actor.parameters(), config['agent.actor.lr'])
+        self.critic_optimizer = make_optimizer(self.critic.parameters(), config['agent.critic.lr'])
         
-        self.max_action = env.action_space.high[0]
         self.total_timestep = 0
         
+        # action bounds on device, both exploration and target actions are clipped without host-side arguments
+        self.register_buffer('action_low', tensorify(env.action_space.low, device))
+        self.register_buffer('action_high', tensorify(env.action_space.high, device))
+        # exploration noise is sampled in chunks and consumed step by step
+        self.action_noise_chunk = 1000
+        self.action_noises = None
+        self.action_noise_pointer = 0
+        
+        # bf16 autocast of network hidden layers on GPU, output heads, losses and gradients stay in fp32
+        # only on GPUs with native bf16 (Ampere+) of our device, emulated bf16 is slower and less precise
+        self.use_bf16 = config['agent.use_bf16'] and use_cuda and torch.cuda.get_device_capability(torch.device(device)) >= (8, 0)
+        self.autocast = lambda: torch.autocast('cuda', dtype=torch.bfloat16, enabled=self.use_bf16)
+        
+        # running moments of both Qs within one learn(), each row: [sum, squared sum, min, max]
+        # updated inside the critic step, float64 avoids cancellation in E[x^2] - E[x]^2
+        self.Q_stats = torch.zeros(2, 4, dtype=torch.float64, device=device)
+        
     def polyak_update_target(self):
         p = self.config['agent.polyak']
-        for param, target_param in zip(self.actor.parameters(), self.actor_target.parameters()):
-            target_param.data.copy_(p*target_param.data + (1 - p)*param.data)
-        for param, target_param in zip(self.critic.parameters(), self.critic_target.parameters()):
-            target_param.data.copy_(p*target_param.data + (1 - p)*param.data)
+        # multi-tensor lerp: target <- p*target + (1 - p)*param, one kernel for all parameters
+        with torch.no_grad():
+            torch._foreach_lerp_(list(self.actor_target.parameters()), list(self.actor.parameters()), 1 - p)
+            torch._foreach_lerp_(list(self.critic_target.parameters()), list(self.critic.parameters()), 1 - p)
 
     def choose_action(self, x, **kwargs):
         obs = tensorify(x.observation, self.device).unsqueeze(0)
         with torch.no_grad():
-            action = numpify(self.actor(obs).squeeze(0), 'float')
-        if kwargs['mode'] == 'train':
-            eps = np.random.normal(0.0, self.config['agent.action_noise'], size=action.shape)
-            action = np.clip(action + eps, self.env.action_space.low, self.env.action_space.high)
+            action = unwrap(self.actor)(obs).squeeze(0)
+            if kwargs['mode'] == 'train':
+                if self.action_noises is None or self.action_noise_pointer == self.action_noise_chunk:
+                    self.action_noises = torch.empty(self.action_noise_chunk, *action.shape, device=self.device)
+                    self.action_noises.normal_(0.0, self.config['agent.action_noise'])
+                    self.action_noise_pointer = 0
+                action = torch.clamp(action + self.action_noises[self.action_noise_pointer], self.action_low, self.action_high)
+                self.action_noise_pointer += 1
         out = {}
-        out['raw_action'] = action
+        out['raw_action'] = numpify(action, 'float')
         return out
 
+    def critic_step(self, observations, actions, rewards, next_observations, masks, target_noises):
+        with self.autocast():
+            Qs = self.critic(observations, actions)
+            with torch.no_grad():
+                next_actions = self.actor_target(next_observations)
+                next_actions = torch.clamp(next_actions + target_noises, self.action_low, self.action_high)
+                next_Qs = self.critic_target(next_observations, next_actions).min(0)[0]
+        targets = rewards + self.config['agent.gamma']*masks*next_Qs
+        # single MSE over both stacked Qs, scaled by 2 to equal the sum of the two MSEs
+        critic_loss = 2*F.mse_loss(Qs, targets.detach().expand_as(Qs))
+        # critic loss does not reach actor parameters, only critic gradients need to be reset
+        self.critic_optimizer.zero_grad(set_to_none=True)
+        critic_loss.backward()
+        critic_grad_norm = nn.utils.clip_grad_norm_(self.critic.parameters(), self.config['agent.max_grad_norm'])
+        self.critic_optimizer.step()
+        with torch.no_grad():
+            Qs = Qs.flatten(1).double()
+            self.Q_stats[:, 0] += Qs.sum(1)
+            self.Q_stats[:, 1] += Qs.pow(2).sum(1)
+            self.Q_stats[:, 2] = torch.min(self.Q_stats[:, 2], Qs.min(1)[0])
+            self.Q_stats[:, 3] = torch.max(self.Q_stats[:, 3], Qs.max(1)[0])
+        return critic_loss, critic_grad_norm
+    
+    def actor_step(self, observations):
+        with self.autocast():
+            # Q1 bypasses the DDP wrapper, only actor gradients are all-reduced in this backward
+            actor_Qs = unwrap(self.critic).Q1(observations, self.actor(observations))
+        actor_loss = -actor_Qs.mean()
+        # only accumulate into actor parameters, critic gradients are neither computed nor reset here
+        self.actor_optimizer.zero_grad(set_to_none=True)
+        actor_loss.backward(inputs=list(self.actor.parameters()))
+        actor_grad_norm = nn.utils.clip_grad_norm_(self.actor.parameters(), self.config['agent.max_grad_norm'])
+        self.actor_optimizer.step()
+        
+        self.polyak_update_target()
+        return actor_loss, actor_grad_norm
+
     def learn(self, D, **kwargs):
         replay = kwargs['replay']
         T = kwargs['T']
-        list_actor_loss = []
-        list_critic_loss = []
-        Q1_vals = []
-        Q2_vals = []
-        for i in range(T):
-            observations, actions, rewards, next_observations, masks = replay.sample(self.config['replay.batch_size'])
-            
-            Qs1, Qs2 = self.critic(observations, actions)
-            with torch.no_grad():
-                next_actions = self.actor_target(next_observations)
-                eps = torch.empty_like(next_actions).normal_(0.0, self.config['agent.target_noise'])
-                eps = eps.clamp(-self.config['agent.target_noise_clip'], self.config['agent.target_noise_clip'])
-                next_actions = torch.clamp(next_actions + eps, -self.max_action, self.max_action)
-                next_Qs1, next_Qs2 = self.critic_target(next_observations, next_actions)
-                next_Qs = torch.min(next_Qs1, next_Qs2)
-                targets = rewards + self.config['agent.gamma']*masks*next_Qs
-            critic_loss = F.mse_loss(Qs1, targets.detach()) + F.mse_loss(Qs2, targets.detach())
-            self.actor_optimizer.zero_grad()
-            self.critic_optimizer.zero_grad()
-            critic_loss.backward()
-            critic_grad_norm = nn.utils.clip_grad_norm_(self.critic.parameters(), self.config['agent.max_grad_norm'])
-            self.critic_optimizer.step()
-            
-            if i % self.config['agent.policy_delay'] == 0:
-                actor_loss = -self.critic.Q1(observations, self.actor(observations)).mean()
-                self.actor_optimizer.zero_grad()
-                self.critic_optimizer.zero_grad()
-                actor_loss.backward()
-                actor_grad_norm = nn.utils.clip_grad_norm_(self.actor.parameters(), self.config['agent.max_grad_norm'])
-                self.actor_optimizer.step()
-                
-                self.polyak_update_target()
-                list_actor_loss.append(actor_loss)
-            list_critic_loss.append(critic_loss)
-            Q1_vals.append(Qs1)
-            Q2_vals.append(Qs2)
+        if self.distributed:  # all ranks must run the same number of gradient steps
+            T = torch.tensor(T, device=self.device)
+            dist.all_reduce(T, op=dist.ReduceOp.MAX)
+            T = T.item()
+        policy_delay = self.config['agent.policy_delay']
+        # preallocated on device: no per-step Python list of graph-holding tensors, no sync until the end
+        critic_losses = torch.empty(T, device=self.device)
+        actor_losses = torch.empty((T + policy_delay - 1)//policy_delay, device=self.device)
+        # reset in place, no new allocation per learn()
+        self.Q_stats[:, :2] = 0.0
+        self.Q_stats[:, 2] = float('inf')
+        self.Q_stats[:, 3] = -float('inf')
+        # target policy smoothing noise for all T minibatches sampled at once
+        target_noises = torch.empty(T, self.config['replay.batch_size'], flatdim(self.env.action_space), device=self.device)
+        target_noises.normal_(0.0, self.config['agent.target_noise'])
+        target_noises.clamp_(-self.config['agent.target_noise_clip'], self.config['agent.target_noise_clip'])
+        batches = Prefetcher(replay, self.config['replay.batch_size'], T)
+        for i, (observations, actions, rewards, next_observations, masks) in enumerate(batches):
+            critic_loss, critic_grad_norm = self.critic_step(observations, actions, rewards, next_observations, masks, target_noises[i])
+            if i % policy_delay == 0:
+                actor_loss, actor_grad_norm = self.actor_step(observations)
+                actor_losses[i//policy_delay] = actor_loss.detach()
+            critic_losses[i] = critic_loss.detach()
         self.total_timestep += T
         
         out = {}
-        out['actor_loss'] = torch.tensor(list_actor_loss).mean(0).item()
-        out['actor_grad_norm'] = actor_grad_norm
-        out['critic_loss'] = torch.tensor(list_critic_loss).mean(0).item()
-        out['critic_grad_norm'] = critic_grad_norm
-        describe_it = lambda x: describe(numpify(torch.cat(x), 'float').squeeze(), axis=-1, repr_indent=1, repr_prefix='\n')
-        out['Q1'] = describe_it(Q1_vals)
-        out['Q2'] = describe_it(Q2_vals)
+        out['actor_loss'] = actor_losses.mean().item()
+        out['actor_grad_norm'] = actor_grad_norm.item()
+        out['critic_loss'] = critic_losses.mean().item()
+        out['critic_grad_norm'] = critic_grad_norm.item()
+        count = T*self.config['replay.batch_size']
+        for (Q_sum, Q_sqsum, Q_min, Q_max), key in zip(self.Q_stats.tolist(), ['Q1', 'Q2']):
+            mean = Q_sum/count
+            std = np.sqrt(max(Q_sqsum/count - mean**2, 0.0))
+            out[key] = Describe(count, mean, std, Q_min, Q_max, repr_indent=1, repr_prefix='\n')
         return out
     
     def checkpoint(self, logdir, num_iter):
-        self.save(logdir/f'agent_{num_iter}.pth')
+        if self.distributed and dist.get_rank() != 0:
+            return
+        # save actor/critic without DDP wrappers, so the checkpoint loads into a non-distributed agent
+        state_dict = {key: value for key, value in self.state_dict().items() if not key.startswith(('actor.', 'critic.'))}
+        state_dict.update(unwrap(self.actor).state_dict(prefix='actor.'))
+        state_dict.update(unwrap(self.critic).state_dict(prefix='critic.'))
+        torch.save(obj=state_dict, f=logdir/f'agent_{num_iter}.pth', pickle_protocol=pickle.HIGHEST_PROTOCOL)
@@ -38,7 +38,8 @@ class EpisodeRunner(BaseRunner):
                 out_agent = agent.choose_action(timestep, **kwargs)
                 action = out_agent.pop('raw_action')
                 timestep = env.step(action)
-                timestep.info = {**timestep.info, **out_agent}
+                if out_agent:  # most agents only return the action, skip the per-step dict copy
+                    timestep.info = {**timestep.info, **out_agent}
                 traj.add(timestep, action)
             traj.extra_info['last_info'] = agent.choose_action(timestep, last_info=True, **kwargs)
             D.append(traj)
@@ -63,7 +64,8 @@ class StepRunner(BaseRunner):
             out_agent = agent.choose_action(timestep, **kwargs)
             action = out_agent.pop('raw_action')
             timestep = env.step(action)
-            timestep.info = {**timestep.info, **out_agent}
+            if out_agent:
+                timestep.info = {**timestep.info, **out_agent}
             traj.add(timestep, action)
             if timestep.last():
                 traj.extra_info['last_info'] = agent.choose_action(timestep, last_info=True, **kwargs)